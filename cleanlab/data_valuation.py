@@ -24,43 +24,114 @@ from typing import Optional, cast
 import numpy as np
 from scipy.sparse import csr_matrix
 from sklearn.neighbors import NearestNeighbors
-from sklearn.exceptions import NotFittedError
-from sklearn.utils.validation import check_is_fitted
 
 
 def _knn_shapley_score(knn_graph: csr_matrix, labels: np.ndarray, k: int) -> np.ndarray:
-    """Compute the Shapley values of data points based on a knn graph."""
+    """Compute the Shapley values of data points based on a knn graph.
+
+    Examples listed among their own neighbors are ignored in their rows, which then only use
+    their remaining neighbors.
+    """
+    N = labels.shape[0]
+    neighbor_indices = knn_graph.indices.reshape(N, -1)
+    is_self = neighbor_indices == np.arange(N)[:, None]
+    if not np.any(is_self):
+        return _knn_shapley_score_dense(neighbor_indices, labels, k)
+
+    # A knn graph built by querying the examples themselves lists examples among their own
+    # neighbors. Move each self entry to the front of its row, so the k furthest neighbors are
+    # taken from the remaining ones, and leave rows without a self entry as they are.
+    order = np.argsort(~is_self, axis=1, kind="stable")
+    idx = np.take_along_axis(neighbor_indices, order, axis=1)[:, -k:]
+    not_self = idx != np.arange(N)[:, None]
+    # Rows with fewer than k remaining neighbors are normalized by the number they actually use
+    num_neighbors = np.maximum(not_self.sum(axis=1), 1)
+    matches = (labels[idx] == labels[:, None]) & not_self
+    weights = np.broadcast_to(1 / num_neighbors[:, None], idx.shape)
+    totals = np.bincount(idx[matches], weights=weights[matches], minlength=N)
+    return 0.5 * (totals / N + 1)
+
+
+def _knn_shapley_score_dense(
+    neighbor_indices: np.ndarray, labels: np.ndarray, k: int
+) -> np.ndarray:
+    """Compute the Shapley values of data points based on the indices of their nearest neighbors,
+    given as an (N, k) array sorted by increasing distance."""
     N = labels.shape[0]
-    scores = np.zeros((N, N))
-    dist = knn_graph.indices.reshape(N, -1)
+    # Compare labels as single bytes when possible, which shrinks the randomly accessed label array
+    # and lets NumPy compare many labels per SIMD instruction
+    if (
+        np.issubdtype(labels.dtype, np.integer)
+        and N > 0
+        and labels.min() >= 0
+        and labels.max() <= np.iinfo(np.uint8).max
+    ):
+        labels = labels.astype(np.uint8)
+
+    # Keep the neighbors in order of increasing distance, so no reversed copy is needed
+    idx = neighbor_indices[:, -k:]
+    # The recursion s[j] = s[j - 1] + (match[j] - match[j - 1]), starting from s[0] = match[0]
+    # at the nearest neighbor, telescopes to s[j] = match[j]. So each query contributes exactly
+    # its label-matching neighbors, which are counted in a single pass.
+    if N > 0 and np.all(labels == labels[0]):
+        # Every neighbor matches, so no labels need to be compared
+        totals = np.bincount(idx.ravel(), minlength=N)
+        return 0.5 * (totals / (N * k) + 1)
+    matches = labels[idx] == labels[:, None]
+    totals = np.bincount(idx[matches], minlength=N)
+    return 0.5 * (totals / (N * k) + 1)
+
+
+def _remove_self_neighbors(neighbor_indices: np.ndarray) -> np.ndarray:
+    """Remove each example from its own list of k + 1 nearest neighbors.
+
+    If an example is not among its own neighbors (e.g. due to duplicate examples),
+    its nearest neighbor is removed instead, like in ``sklearn.neighbors.NearestNeighbors``.
+    """
+    N = neighbor_indices.shape[0]
+    is_self = neighbor_indices == np.arange(N)[:, None]
+    is_self[~is_self.any(axis=1), 0] = True
+    return neighbor_indices[~is_self].reshape(N, -1)
 
-    for y, s, dist_i in zip(labels, scores, dist):
-        idx = dist_i[::-1]
-        ans = labels[idx]
-        s[idx[k - 1]] = float(ans[k - 1] == y)
-        ans_matches = (ans == y).flatten()
-        for j in range(k - 2, -1, -1):
-            s[idx[j]] = s[idx[j + 1]] + float(int(ans_matches[j]) - int(ans_matches[j + 1]))
-    return 0.5 * (np.mean(scores / k, axis=0) + 1)
+
+def _approximate_neighbor_indices(
+    features: np.ndarray, metric: str, k: int, n_jobs: int = -1
+) -> np.ndarray:
+    """Find the approximate k nearest neighbors of each example with pynndescent."""
+    try:
+        from pynndescent import NNDescent
+    except ImportError:
+        raise ImportError(
+            "Approximate nearest neighbor search requires pynndescent. "
+            "Install it via: `pip install pynndescent`"
+        )
+    # The neighbor graph of the index includes each example itself
+    index = NNDescent(features, n_neighbors=k + 1, metric=metric, n_jobs=n_jobs, random_state=0)
+    return _remove_self_neighbors(index.neighbor_graph[0])
 
 
 def _process_knn_graph_from_features(
-    features: np.ndarray, metric: Optional[str], k: int = 10
-) -> csr_matrix:
-    """Calculate the knn graph from the features if it is not provided in the kwargs."""
+    features: np.ndarray,
+    metric: Optional[str],
+    k: int = 10,
+    n_jobs: int = -1,
+    approximate_knn: bool = False,
+) -> np.ndarray:
+    """Calculate the indices of the k nearest neighbors of each example from the features,
+    if a knn graph is not provided in the kwargs."""
     if k > len(features):  # Ensure number of neighbors less than number of examples
         raise ValueError(
             f"Number of nearest neighbors k={k} cannot exceed the number of examples N={len(features)} passed into the estimator (knn)."
         )
     if metric == None:
         metric = "cosine" if features.shape[1] > 3 else "euclidean"
-    knn = NearestNeighbors(n_neighbors=k, metric=metric).fit(features)
-    knn_graph = knn.kneighbors_graph(mode="distance")
-    try:
-        check_is_fitted(knn)
-    except NotFittedError:
-        knn.fit(features)
-    return knn_graph
+    if approximate_knn:
+        return _approximate_neighbor_indices(features, metric, k, n_jobs)
+    knn = NearestNeighbors(n_neighbors=k, metric=metric, n_jobs=n_jobs).fit(features)
+    # sklearn already queries the neighbors in memory-bounded chunks and, without distances,
+    # only keeps their indices. Querying the training data itself (X=None) also lets it break ties
+    # between exact duplicates in favor of each example itself, before excluding it.
+    return knn.kneighbors(return_distance=False)
 
 
 def data_shapley_knn(
@@ -70,6 +141,8 @@ def data_shapley_knn(
     knn_graph: Optional[csr_matrix] = None,
     metric: Optional[str] = None,
     k: int = 10,
+    n_jobs: int = -1,
+    approximate_knn: bool = False,
 ) -> np.ndarray:
     """
     Compute the Data Shapley values of data points using a K-Nearest Neighbors (KNN) graph.
@@ -94,6 +167,8 @@ def data_shapley_knn(
             If provided, this must be a 2D array with shape (num_examples, num_features).
     knn_graph :
         A precomputed sparse KNN graph. If not provided, it will be computed from the `features` using the specified `metric`.
+        If the graph lists an example among its own neighbors (e.g. when it was built by querying the same examples it was fit on),
+        that entry is ignored and the example's remaining neighbors are used instead.
     metric : Optional[str], default=None
         The distance metric for KNN graph construction.
         Supports metrics available in ``sklearn.neighbors.NearestNeighbors``
@@ -102,6 +177,15 @@ def data_shapley_knn(
         The number of neighbors to consider for the KNN graph and Data Shapley value computation.
         Must be less than the total number of data points.
         The value may not exceed the number of neighbors of each data point stored in the KNN graph.
+    n_jobs :
+        The number of parallel jobs used to construct the KNN graph from `features`.
+        ``-1`` means using all processors. Ignored if `knn_graph` is provided.
+    approximate_knn :
+        Whether to construct the KNN graph from `features` with the approximate nearest neighbor search
+        of ``pynndescent`` instead of the exact search of ``sklearn``.
+        This is much faster for large datasets with high-dimensional features, but the resulting
+        scores are approximate. Requires ``pynndescent`` to be installed.
+        Ignored if `knn_graph` is provided.
 
     Returns
     -------
@@ -129,5 +213,8 @@ def data_shapley_knn(
         raise ValueError("Either knn_graph or features must be provided.")
 
     if knn_graph is None:
-        knn_graph = _process_knn_graph_from_features(cast(np.ndarray, features), metric, k)
+        neighbor_indices = _process_knn_graph_from_features(
+            cast(np.ndarray, features), metric, k, n_jobs, approximate_knn
+        )
+        return _knn_shapley_score_dense(neighbor_indices, labels, k)
     return _knn_shapley_score(knn_graph, labels, k)
@@ -14,12 +14,22 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with cleanlab.  If not, see <https://www.gnu.org/licenses/>.
 
+import sys
+
 import numpy as np
 import pytest
 
+from scipy.sparse import csr_matrix
 from sklearn.neighbors import NearestNeighbors
 
-from cleanlab.data_valuation import data_shapley_knn
+from cleanlab.data_valuation import (
+    data_shapley_knn,
+    _approximate_neighbor_indices,
+    _process_knn_graph_from_features,
+    _knn_shapley_score,
+    _knn_shapley_score_dense,
+    _remove_self_neighbors,
+)
 
 
 class TestDataValuation:
@@ -52,3 +62,120 @@ class TestDataValuation:
         assert shapley.shape == (100,)
         assert np.all(shapley >= 0)
         assert np.all(shapley <= 1)
+
+    def test_knn_shapley_score_with_neighbor_indices(self, labels, features, knn_graph):
+        knn = NearestNeighbors(n_neighbors=self.K).fit(features)
+        neighbor_indices = knn.kneighbors(return_distance=False)
+        shapley_dense = _knn_shapley_score_dense(neighbor_indices, labels, self.K)
+        shapley_sparse = _knn_shapley_score(knn_graph, labels, self.K)
+        np.testing.assert_allclose(shapley_dense, shapley_sparse)
+
+    def test_remove_self_neighbors(self, features):
+        knn = NearestNeighbors(n_neighbors=self.K).fit(features)
+        neighbors_with_self = knn.kneighbors(
+            features, n_neighbors=self.K + 1, return_distance=False
+        )
+        np.testing.assert_array_equal(
+            _remove_self_neighbors(neighbors_with_self), knn.kneighbors(return_distance=False)
+        )
+        # Drop the nearest neighbor if an example is not among its own neighbors
+        neighbor_indices = np.array([[1, 2, 3], [0, 1, 3]])
+        np.testing.assert_array_equal(
+            _remove_self_neighbors(neighbor_indices), np.array([[2, 3], [0, 3]])
+        )
+
+    @pytest.mark.parametrize("k", [2, 3])
+    def test_knn_shapley_score_skips_self_neighbors(self, labels, features, k):
+        knn = NearestNeighbors(n_neighbors=k).fit(features)
+        # Each example is its own nearest neighbor in this graph
+        knn_graph_with_self = knn.kneighbors_graph(features, n_neighbors=k)
+        shapley_with_self = _knn_shapley_score(knn_graph_with_self, labels, k)
+        # Same neighbors without the examples themselves, normalized by the k - 1 neighbors used
+        knn_graph = knn.kneighbors_graph(n_neighbors=k - 1)
+        np.testing.assert_allclose(shapley_with_self, _knn_shapley_score(knn_graph, labels, k - 1))
+
+        # No neighbors remain with k=1
+        knn_graph_with_self = knn.kneighbors_graph(features, n_neighbors=1)
+        np.testing.assert_allclose(_knn_shapley_score(knn_graph_with_self, labels, 1), 0.5)
+
+    @pytest.mark.parametrize("graph_type", ["ann", "sklearn"])
+    def test_knn_shapley_score_skips_self_neighbors_per_row(self, labels, features, graph_type):
+        k = self.K
+        knn = NearestNeighbors().fit(features)
+        if graph_type == "ann":
+            # Query k + 1 neighbors and drop the first one. With a single pair of duplicates,
+            # at most one row still contains its own example.
+            features[1] = features[0]
+            knn.fit(features)
+            knn_graph = knn.kneighbors_graph(features, n_neighbors=k + 1)
+            indices = knn_graph.indices.reshape(self.N, -1)[:, 1:]
+        else:
+            # With many duplicates, some rows list another duplicate instead of their own example
+            features[:30] = features[0]
+            knn.fit(features)
+            indices = knn.kneighbors(features, n_neighbors=k, return_distance=False)
+        knn_graph = csr_matrix(
+            (np.ones(indices.size), indices.ravel(), np.arange(0, indices.size + 1, k)),
+            shape=(self.N, self.N),
+        )
+
+        totals = np.zeros(self.N)
+        for i, row in enumerate(indices):
+            neighbors = row[row != i][-k:]
+            totals[neighbors] += (labels[neighbors] == labels[i]) / len(neighbors)
+        expected = 0.5 * (totals / self.N + 1)
+
+        np.testing.assert_allclose(_knn_shapley_score(knn_graph, labels, k), expected)
+
+    @pytest.mark.parametrize("k", [1, 5, 10, 20])
+    def test_knn_shapley_score_matches_recursive_definition(self, k):
+        N = 200
+        labels = np.random.randint(0, 3, N)
+        features = np.random.rand(N, self.num_features)
+        neighbor_indices = NearestNeighbors(n_neighbors=k).fit(features).kneighbors()[1]
+
+        scores = np.zeros((N, N))
+        for i in range(N):
+            idx = neighbor_indices[i][::-1]
+            matches = labels[idx] == labels[i]
+            scores[i, idx[k - 1]] = matches[k - 1]
+            for j in range(k - 2, -1, -1):
+                scores[i, idx[j]] = scores[i, idx[j + 1]] + int(matches[j]) - int(matches[j + 1])
+        expected = 0.5 * (np.mean(scores / k, axis=0) + 1)
+
+        np.testing.assert_allclose(_knn_shapley_score_dense(neighbor_indices, labels, k), expected)
+
+    @pytest.mark.parametrize("metric", ["euclidean", "cosine"])
+    @pytest.mark.parametrize("num_duplicates", [0, 30])
+    def test_process_knn_graph_from_features(self, features, metric, num_duplicates):
+        # Many exact duplicates, so that some examples are not among their own k + 1 neighbors
+        features[:num_duplicates] = features[0]
+        neighbor_indices = _process_knn_graph_from_features(features, metric, self.K)
+        knn = NearestNeighbors(n_neighbors=self.K, metric=metric).fit(features)
+        np.testing.assert_array_equal(neighbor_indices, knn.kneighbors(return_distance=False))
+
+    def test_data_shapley_knn_with_identical_labels(self):
+        labels = np.zeros(5, dtype=int)
+        features = np.array([[0, 1, 2, 3, 4]]).T
+        # Every example is a neighbor of all other examples, and all of them match
+        shapley = data_shapley_knn(labels, features=features, k=4)
+        np.testing.assert_allclose(shapley, 0.6)
+
+    def test_approximate_neighbor_indices(self, features):
+        pytest.importorskip("pynndescent")
+        neighbor_indices = _approximate_neighbor_indices(features, "euclidean", self.K)
+        assert neighbor_indices.shape == (self.N, self.K)
+        assert not np.any(neighbor_indices == np.arange(self.N)[:, None])
+        # Mostly the exact neighbors, and reproducible
+        knn = NearestNeighbors(n_neighbors=self.K).fit(features)
+        exact_indices = knn.kneighbors(return_distance=False)
+        recall = np.mean([np.isin(a, b).mean() for a, b in zip(neighbor_indices, exact_indices)])
+        assert recall > 0.9
+        np.testing.assert_array_equal(
+            neighbor_indices, _approximate_neighbor_indices(features, "euclidean", self.K)
+        )
+
+    def test_approximate_knn_requires_pynndescent(self, labels, features, monkeypatch):
+        monkeypatch.setitem(sys.modules, "pynndescent", None)
+        with pytest.raises(ImportError, match="pynndescent"):
+            data_shapley_knn(labels, features=features, k=self.K, approximate_knn=True)